@@ -4,17 +4,24 @@ UI State Capture System (Humann in the Loop Login Handling)
 """
 
 import asyncio
-import base64
+import hashlib
 import json
 import os
+import re
+import sys
+import time
 from pathlib import Path
 from datetime import datetime
 from typing import Optional, List
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from browser_use import Agent, Browser
-from browser_use.browser.events import ScreenshotEvent
 from browser_use.agent.views import AgentSettings
 from browser_use.llm import ChatGoogle
 
@@ -32,6 +39,9 @@ LOGIN_PAGE_INDICATORS = [
     "forgot password", "create account", "register","signup"
 ]
 
+_LOGIN_URL_RE = re.compile("|".join(map(re.escape, LOGIN_URL_PATTERNS)), re.IGNORECASE)
+_LOGIN_TITLE_RE = re.compile("|".join(map(re.escape, LOGIN_PAGE_INDICATORS)), re.IGNORECASE)
+
 
 
 # DATASET SCHEMA
@@ -68,6 +78,9 @@ class CapturedWorkflow(BaseModel):
 
 # CONFIGURATION
 
+SCREENSHOT_FORMAT = "jpeg"
+SCREENSHOT_QUALITY = 80
+MAX_CONCURRENT_APPS = 3
 
 APP_CONFIG = {
     "linear": {"url": "https://linear.app", "name": "Linear"},
@@ -77,6 +90,18 @@ APP_CONFIG = {
 }
 
 
+class _SafeNameTable(dict):
+    # str.translate table mapping every non-alphanumeric character to "_",
+    # filled lazily so non-ASCII input is handled the same way as ASCII
+    def __missing__(self, codepoint: int) -> str:
+        char = chr(codepoint)
+        self[codepoint] = char if char.isalnum() else "_"
+        return self[codepoint]
+
+
+_SAFE_NAME_TABLE = _SafeNameTable()
+
+
 def detect_app(user_input: str) -> tuple[str, dict]:
     input_lower = user_input.lower()
     for app_key, config in APP_CONFIG.items():
@@ -106,68 +131,86 @@ COMPLETION: Task is complete when the requested action has been performed."""
 
 
 def is_login_page(url: str, title: str = "") -> bool:
-    url_lower = url.lower()
-    title_lower = title.lower()
-    
-    for pattern in LOGIN_URL_PATTERNS:
-        if pattern in url_lower:
-            return True
-    
-    for indicator in LOGIN_PAGE_INDICATORS:
-        if indicator in title_lower:
-            return True
-    
-    return False
+    return bool(_LOGIN_URL_RE.search(url) or _LOGIN_TITLE_RE.search(title))
 
 
 
 # CAPTURE HOOK WITH LOGIN DETECTION
 
+_login_prompt_lock = asyncio.Lock()
+
+def last_model_action(agent: Agent) -> Optional[dict]:
+    # Same shape as agent.history.model_actions()[-1], without dumping the whole history
+    for entry in reversed(agent.history.history):
+        if not entry.model_output:
+            continue
+        actions = entry.model_output.action
+        interacted = entry.state.interacted_element or [None] * len(actions)
+        last_index = min(len(actions), len(interacted)) - 1
+        if last_index >= 0:
+            output = actions[last_index].model_dump(exclude_none=True)
+            output['interacted_element'] = interacted[last_index]
+            return output
+    return None
+
 
 def create_capture_hook(output_dir: Path, workflow: CapturedWorkflow):
     step_data = {
         "count": 0, 
         "step_start_time": None,
         "login_handled": False,
-        "waiting_for_login": False
+        "waiting_for_login": False,
+        "last_screenshot_hash": None,
+        "last_screenshot": None,
     }
+    pending_writes: dict[str, asyncio.Task] = {}
+    
+    def record_step(step: CapturedStep):
+        # workflow.steps is preallocated to max_steps slots by execute_task
+        if step.step_number <= len(workflow.steps):
+            workflow.steps[step.step_number - 1] = step
+        else:
+            workflow.steps.append(step)
     
     async def on_step_start(agent: Agent):
-        step_data["step_start_time"] = datetime.now()
+        step_data["step_start_time"] = time.perf_counter()
     
     async def on_step_end(agent: Agent):
         step_data["count"] += 1
         step_num = step_data["count"]
         
         try:
-            state = await agent.browser_session.get_browser_state_summary()
+            # The hook takes its own screenshot below, so skip the one in the summary
+            state = await agent.browser_session.get_browser_state_summary(include_screenshot=False)
             current_url = state.url if state else "unknown"
-            current_title = await agent.browser_session.get_current_page_title() or "untitled"
+            current_title = (state.title if state else "") or "untitled"
             
             if is_login_page(current_url, current_title) and not step_data["login_handled"]:
                 step_data["waiting_for_login"] = True
                 
-                print("\n" + "="*60)
-                print("LOGIN PAGE DETECTED")
-                print("="*60)
-                print(f"   URL: {current_url}")
-                print(f"   Title: {current_title}")
-                print("\n   Please log in manually in the browser window.")
-                print("   Press ENTER here when you are done logging in.")
-                print("="*60 + "\n")
-                
-                agent.pause()
-                
-                await asyncio.get_event_loop().run_in_executor(None, input)
+                # Tasks run concurrently but share one terminal, so prompt one login at a time
+                async with _login_prompt_lock:
+                    print("\n" + "="*60)
+                    print("LOGIN PAGE DETECTED")
+                    print("="*60)
+                    print(f"   URL: {current_url}")
+                    print(f"   Title: {current_title}")
+                    print("\n   Please log in manually in the browser window.")
+                    print("   Press ENTER here when you are done logging in.")
+                    print("="*60 + "\n")
+                    
+                    agent.pause()
+                    
+                    await asyncio.to_thread(sys.stdin.readline)
+                    
+                    agent.resume()
+                    
+                    step_data["login_handled"] = True
+                    step_data["waiting_for_login"] = False
+                    
+                    print("Login completed. Resuming agent.\n")
                 
-                agent.resume()
-                
-                step_data["login_handled"] = True
-                step_data["waiting_for_login"] = False
-                
-                print("Login completed. Resuming agent.\n")
-                
-                workflow.steps.append(CapturedStep(
+                record_step(CapturedStep.model_construct(
                     step_number=step_num,
                     timestamp=datetime.now().isoformat(),
                     action_type="manual_login",
@@ -179,40 +222,44 @@ def create_capture_hook(output_dir: Path, workflow: CapturedWorkflow):
                 ))
                 return
             
-            screenshot_event = agent.browser_session.event_bus.dispatch(
-                ScreenshotEvent(full_page=True)
-            )
-            await screenshot_event
-            screenshot_result = await screenshot_event.event_result(
-                raise_if_any=True, raise_if_none=True
+            # take_screenshot bypasses ScreenshotWatchdog, which clears interaction
+            # highlights first; do the same so overlays don't end up in the dataset
+            try:
+                await agent.browser_session.remove_highlights()
+            except Exception:
+                pass
+            
+            screenshot_bytes = await agent.browser_session.take_screenshot(
+                full_page=True,
+                format=SCREENSHOT_FORMAT,
+                quality=SCREENSHOT_QUALITY,
             )
             
-            if isinstance(screenshot_result, bytes):
-                screenshot_bytes = screenshot_result
-            elif isinstance(screenshot_result, str):
-                screenshot_bytes = base64.b64decode(screenshot_result)
+            # Identical frames point at the previous file instead of writing a duplicate
+            screenshot_hash = hashlib.blake2b(screenshot_bytes, digest_size=16).digest()
+            if screenshot_hash == step_data["last_screenshot_hash"]:
+                filename = step_data["last_screenshot"]
             else:
-                screenshot_bytes = base64.b64decode(str(screenshot_result))
-            
-            filename = f"step_{step_num:03d}.png"
-            (output_dir / filename).write_bytes(screenshot_bytes)
+                filename = f"step_{step_num:03d}.jpg"
+                pending_writes[filename] = asyncio.create_task(
+                    asyncio.to_thread((output_dir / filename).write_bytes, screenshot_bytes)
+                )
+                step_data["last_screenshot_hash"] = screenshot_hash
+                step_data["last_screenshot"] = filename
             
-            actions = agent.history.model_actions()
+            last = last_model_action(agent)
             action_type = "initial"
             action_desc = "Initial state"
             
-            if actions and len(actions) > 0:
-                last = actions[-1]
-                if isinstance(last, list) and len(last) > 0:
-                    last = last[0]
+            if last is not None:
                 action_type = getattr(last, 'name', str(type(last).__name__))
                 action_desc = str(last)[:200]
             
             duration_ms = None
-            if step_data["step_start_time"]:
-                duration_ms = (datetime.now() - step_data["step_start_time"]).total_seconds() * 1000
+            if step_data["step_start_time"] is not None:
+                duration_ms = (time.perf_counter() - step_data["step_start_time"]) * 1000
             
-            workflow.steps.append(CapturedStep(
+            record_step(CapturedStep.model_construct(
                 step_number=step_num,
                 timestamp=datetime.now().isoformat(),
                 action_type=action_type,
@@ -228,17 +275,33 @@ def create_capture_hook(output_dir: Path, workflow: CapturedWorkflow):
         except Exception as e:
             print(f"Capture error: {e}")
     
-    return on_step_start, on_step_end
+    async def flush_screenshots():
+        results = await asyncio.gather(*pending_writes.values(), return_exceptions=True)
+        failed = set()
+        for filename, write_result in zip(pending_writes, results):
+            if isinstance(write_result, Exception):
+                print(f"Screenshot write error: {write_result}")
+                failed.add(filename)
+        
+        # Deduplicated steps may reuse a file whose write failed, so check every step
+        for step in workflow.steps:
+            if step is not None and step.screenshot in failed:
+                step.screenshot = ""
+                step.error_message = "Screenshot could not be saved"
+    
+    return on_step_start, on_step_end, flush_screenshots
 
 
 
 # MAIN EXECUTION (MODIFIED)
 
-async def execute_task(user_input: str, browser, llm, agent_settings, max_steps: int = 25) -> CapturedWorkflow:
-
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        raise ValueError("Missing GOOGLE_API_KEY")
+async def execute_task(
+    user_input: str,
+    browser,
+    llm,
+    agent_settings,
+    max_steps: int = 25,
+) -> CapturedWorkflow:
     
     print(f"\n{'='*70}")
     print(f"TASK: {user_input}")
@@ -250,20 +313,21 @@ async def execute_task(user_input: str, browser, llm, agent_settings, max_steps:
     action_task = transform_to_action_task(user_input, app_config)
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    safe_name = "".join(c if c.isalnum() or c == " " else "_" for c in user_input[:40]).replace(" ", "_")
+    safe_name = user_input[:40].translate(_SAFE_NAME_TABLE)
     output_dir = Path("ui_dataset") / f"{timestamp}_{app_key}_{safe_name}"
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    workflow = CapturedWorkflow(
-        task_id=f"{timestamp}_{app_key}",
+    workflow = CapturedWorkflow.model_construct(
+        task_id=f"{timestamp}_{app_key}_{safe_name}",
         original_query=user_input,
         transformed_task=action_task,
         app_name=app_config.get("name", "Unknown"),
         app_url=app_config.get("url", ""),
         started_at=datetime.now().isoformat(),
+        steps=[None] * max_steps,
     )
     
-    on_step_start, on_step_end = create_capture_hook(output_dir, workflow)
+    on_step_start, on_step_end, flush_screenshots = create_capture_hook(output_dir, workflow)
     
     agent = Agent(
         task=action_task,
@@ -296,16 +360,26 @@ async def execute_task(user_input: str, browser, llm, agent_settings, max_steps:
         workflow.success = False
         workflow.error_summary = str(e)
     
-    (output_dir / "workflow.json").write_text(
-        workflow.model_dump_json(indent=2),
-        encoding='utf-8'
-    )
+    finally:
+        await flush_screenshots()
+    
+    workflow.steps = [step for step in workflow.steps if step is not None]
+    
+    if orjson is not None:
+        (output_dir / "workflow.json").write_bytes(
+            orjson.dumps(workflow.model_dump(mode="json"), option=orjson.OPT_INDENT_2)
+        )
+    else:
+        (output_dir / "workflow.json").write_text(
+            workflow.model_dump_json(indent=2),
+            encoding='utf-8'
+        )
     
     print(f"Saved to: {output_dir}")
     return workflow
 
 
-# MAIN (MODIFIED FOR SHARED BROWSER/LLM/SETTINGS)
+# MAIN (CONCURRENT APPS, SHARED LLM/SETTINGS)
 
 async def main():
 
@@ -313,12 +387,7 @@ async def main():
     if not api_key:
         raise ValueError("Missing GOOGLE_API_KEY")
 
-    print("\nInitializing shared Browser and LLM settings.\n")
-
-    browser = Browser(
-        headless=False,
-        keep_alive=True
-    )
+    print("\nInitializing shared LLM settings.\n")
 
     llm = ChatGoogle(
         model="gemini-2.0-flash",
@@ -342,18 +411,36 @@ async def main():
         "How do i delete the sprint tracker database in Notion?"
     ]
 
+    tasks_by_app: dict[str, List[str]] = {}
     for task in tasks:
-        await execute_task(
-            task,
-            browser=browser,
-            llm=llm,
-            agent_settings=agent_settings
-        )
-        await asyncio.sleep(2)
-
-    print("\nClosing shared browser...")
-    await browser.kill()
-    print("Browser closed.")
+        app_key, _ = detect_app(task)
+        tasks_by_app.setdefault(app_key, []).append(task)
+
+    app_slots = asyncio.Semaphore(MAX_CONCURRENT_APPS)
+
+    # Tasks for the same app build on each other (create before delete), so each
+    # app gets one browser that runs its tasks in order; different apps overlap
+    async def run_app_tasks(app_tasks: List[str]):
+        async with app_slots:
+            browser = Browser(
+                headless=False,
+                keep_alive=True
+            )
+            try:
+                for task in app_tasks:
+                    await execute_task(
+                        task,
+                        browser=browser,
+                        llm=llm,
+                        agent_settings=agent_settings,
+                    )
+                    await asyncio.sleep(2)
+            finally:
+                print("\nClosing app browser...")
+                await browser.kill()
+                print("Browser closed.")
+
+    await asyncio.gather(*(run_app_tasks(app_tasks) for app_tasks in tasks_by_app.values()))
 
 
 if __name__ == "__main__":